@@ -16,6 +16,7 @@
 # http://docs.python.org/2/library/ctypes.html
 
 from ctypes import *
+from timeit import default_timer
 
 # libreadline.so and libhistory.so must be on LD_LIBRARY_PATH
 libreadline = cdll.LoadLibrary('libreadline.so')
@@ -80,6 +81,12 @@ rl_completion_suppress_append = c_int.in_dll(libreadline,
 rl_readline_name = c_char_p.in_dll(libreadline, "rl_readline_name")
 rl_terminal_name = c_char_p.in_dll(libreadline, "rl_terminal_name")
 emacs_meta_keymap = KEYMAP_ENTRY.in_dll(libreadline, "emacs_meta_keymap")
+# The keymap in which the currently executing command was found. This is only
+# exported by readline 6.3+, so Python key bindings are unavailable without it.
+try:
+    rl_executing_keymap = Keymap.in_dll(libreadline, "rl_executing_keymap")
+except ValueError:
+    rl_executing_keymap = None
 
 # GNU readline functions: specify required argument and return types
 rl_completion_matches = libreadline.rl_completion_matches
@@ -103,6 +110,25 @@ rl_bind_key.restype = c_int
 rl_bind_key_in_map = libreadline.rl_bind_key_in_map
 rl_bind_key_in_map.argtypes = [c_int, POINTER(RL_COMMAND_FUNC_T), Keymap]
 rl_bind_key_in_map.restype = c_int
+# rl_command_func_t * is already a function pointer, so the trampoline is
+# passed as RL_COMMAND_FUNC_T directly rather than as a POINTER to one.
+# Attribute access on a CDLL caches the function object, so index the library
+# to get a separate function object and leave rl_bind_key_in_map untouched.
+rl_bind_key_func_in_map = libreadline['rl_bind_key_in_map']
+rl_bind_key_func_in_map.argtypes = [c_int, RL_COMMAND_FUNC_T, Keymap]
+rl_bind_key_func_in_map.restype = c_int
+rl_unbind_key_in_map = libreadline.rl_unbind_key_in_map
+rl_unbind_key_in_map.argtypes = [c_int, Keymap]
+rl_unbind_key_in_map.restype = c_int
+rl_get_keymap = libreadline.rl_get_keymap
+rl_get_keymap.argtypes = []
+rl_get_keymap.restype = Keymap
+rl_variable_value = libreadline.rl_variable_value
+rl_variable_value.argtypes = [c_char_p]
+rl_variable_value.restype = c_char_p
+rl_ding = libreadline.rl_ding
+rl_ding.argtypes = []
+rl_ding.restype = c_int
 rl_insert = libreadline.rl_insert
 rl_insert.argtypes = [c_int, c_int]
 rl_insert.restype = c_int
@@ -598,6 +624,176 @@ def on_pre_input_hook():
     return on_hook(pre_input_hook.value)
 
 
+# Python key bindings
+# ===================
+# Every Python key binding is bound in libreadline to the same C callback,
+# `_key_dispatch_trampoline`, which looks up the Python function in
+# `_key_bindings` by the executing keymap and key. Only one ctypes callback
+# object is ever created, no matter how many keys are bound, and it lives for
+# the life of the module so libreadline never calls into freed memory.
+
+_key_bindings = {} # (keymap address, key) -> (function, binding)
+_key_binding_timings = {} # binding -> [calls, total seconds]
+_key_binding_timing = py_object(False) # do not time bindings by default
+
+# GNU chardefs.h and keymaps.h
+ESC = 0x1b
+ISFUNC = '\x00'
+ISKMAP = '\x01'
+
+
+def _keymap_address(keymap):
+    return cast(keymap, c_void_p).value
+
+
+def _get_keymap(keymap=None):
+    # Return the named keymap, or the current keymap if keymap is `None`.
+    if keymap == None:
+        return rl_get_keymap()
+    elif type(keymap) in [str, unicode]:
+        km = rl_get_keymap_by_name(str(keymap))
+        if not km:
+            raise ValueError('unknown keymap %r' % keymap)
+        return km
+    else:
+        raise TypeError('keymap must be a keymap name')
+
+
+def _converts_meta(key):
+    # rl_bind_key binds a meta key as ESC followed by UNMETA(key) when
+    # convert-meta is on.
+    return key > 0x7f and rl_variable_value('convert-meta') == 'on'
+
+
+def _find_trampoline(key, km):
+    # Return the (keymap address, key) where rl_executing_keymap and key point
+    # when readline calls the trampoline bound to key in km, or `None` if key
+    # is not bound to the trampoline. A meta key may be in km itself or, as
+    # UNMETA(key), in the ESC-prefixed keymap, depending on convert-meta and
+    # on whether km[ESC] was already a keymap when it was bound.
+    trampoline = cast(_key_dispatch_trampoline, c_void_p).value
+    if (km[key].type == ISFUNC
+            and cast(km[key].function, c_void_p).value == trampoline):
+        return (_keymap_address(km), key)
+    if key > 0x7f and km[ESC].type == ISKMAP:
+        escmap = cast(km[ESC].function, Keymap)
+        entry = escmap[key & 0x7f]
+        if (entry.type == ISFUNC
+                and cast(entry.function, c_void_p).value == trampoline):
+            return (_keymap_address(escmap), key & 0x7f)
+    return None
+
+
+def _on_key_dispatch(count, key):
+    entry = _key_bindings.get((_keymap_address(rl_executing_keymap), key))
+    if entry == None:
+        # The trampoline is bound to a key missing from _key_bindings.
+        rl_ding()
+        return 0
+    func, binding = entry
+    if not _key_binding_timing.value:
+        r = func(count, key)
+    else:
+        start = default_timer()
+        r = func(count, key)
+        elapsed = default_timer() - start
+        timing = _key_binding_timings.setdefault(binding, [0, 0.0])
+        timing[0] += 1
+        timing[1] += elapsed
+    result = int(0)
+    if r != None:
+        result = int(r)
+    return result
+
+
+_key_dispatch_trampoline = RL_COMMAND_FUNC_T(_on_key_dispatch)
+
+
+# Exported function to bind a key to a Python function
+
+def bind_key(key, function=None, keymap=None):
+    """
+    bind_key(key, [function], [keymap]) -> None
+    Bind key to a Python function, or remove the binding if function
+    is None. Key is a character or its integer code. The function is
+    called as function(count, key) and may return an int status.
+    Keymap is a keymap name such as "emacs-meta" or "vi-insert"; the
+    default is the current keymap. Prefix keys such as C-x in emacs
+    cannot be bound. Requires readline 6.3 or later.
+    """
+    if rl_executing_keymap == None:
+        raise NotImplementedError('bind_key requires readline 6.3 or later')
+    if type(key) in [str, unicode]:
+        if len(key) != 1:
+            raise ValueError('key must be a single character')
+        key = ord(key)
+    elif type(key) != int:
+        raise TypeError('key must be a character or an integer')
+    if key < 0 or key > 0xff:
+        raise ValueError('invalid key %d' % key)
+    if function != None and not hasattr(function, '__call__'):
+        raise TypeError('object is not callable')
+    km = _get_keymap(keymap)
+    # readline binds a prefix key as a shadow function in its keymap, where
+    # the trampoline cannot tell it apart from the key it was called for.
+    if km[key].type == ISKMAP and not _converts_meta(key):
+        raise ValueError('key %d is a prefix key' % key)
+    binding = (_keymap_address(km), key)
+    if function == None:
+        dispatch = _find_trampoline(key, km)
+        errno = rl_unbind_key_in_map(key, km)
+        if errno:
+            raise ValueError('invalid key %d' % key)
+        if dispatch != None:
+            old = _key_bindings.pop(dispatch, None)
+            if old != None:
+                _key_binding_timings.pop(old[1], None)
+        _key_binding_timings.pop(binding, None)
+    else:
+        errno = rl_bind_key_func_in_map(key, _key_dispatch_trampoline, km)
+        if errno:
+            raise ValueError('invalid key %d' % key)
+        # Look up where readline put the trampoline rather than predicting
+        # it, since rl_bind_key may have created a new ESC-prefixed keymap.
+        dispatch = _find_trampoline(key, km)
+        # Timings belong to the function and key they were collected for, so
+        # discard them when the binding is replaced.
+        old = _key_bindings.get(dispatch)
+        if old != None and old != (function, binding):
+            _key_binding_timings.pop(old[1], None)
+        _key_bindings[dispatch] = (function, binding)
+
+
+# Enable or disable timing of Python key bindings
+
+def set_key_binding_timing(enabled):
+    """
+    set_key_binding_timing(enabled) -> None
+    Enable or disable timing of Python key binding calls. Disabling
+    timing discards any timings collected so far.
+    """
+    _key_binding_timing.value = bool(enabled)
+    if not enabled:
+        _key_binding_timings.clear()
+
+
+# Get the call timings of Python key bindings
+
+def get_key_binding_timings(keymap=None):
+    """
+    get_key_binding_timings([keymap]) -> dict
+    return {key: (calls, total_seconds)} for each timed Python key
+    binding made in keymap. Keymap is a keymap name as for bind_key;
+    the default is the current keymap.
+    """
+    address = _keymap_address(_get_keymap(keymap))
+    timings = {}
+    for (km, key), (calls, total) in _key_binding_timings.items():
+        if km == address:
+            timings[key] = (calls, total)
+    return timings
+
+
 # C function to call the Python completion_display_matches
 
 def on_completion_display_matches_hook(matches, num_matches, max_length):